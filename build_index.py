@@ -22,177 +22,397 @@ based on the recipes' metadata.
 """
 
 
+import hashlib
 import json
 import os
 import plistlib
 import re
 import subprocess
-from glob import glob
+import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from xml.parsers.expat import ExpatError
 
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+# Fetches the repo metadata needed to decide which repos to clone
+REPOS_QUERY = """
+query($cursor: String) {
+  organization(login: "autopkg") {
+    repositories(first: 100, after: $cursor) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        nameWithOwner
+        url
+        isPrivate
+        isFork
+        isArchived
+        isDisabled
+        isTemplate
+      }
+    }
+  }
+}
+"""
+
+# Repos with any of these flags set, or with these names, aren't indexed
+EXCL_REASONS = ("private", "fork", "archived", "disabled", "is_template")
+EXCL_NAMES = frozenset(
+    ("autopkg/autopkg", "autopkg/index", "autopkg/setup-autopkg-actions")
+)
+
+# Bare mirrors of each repo are kept here, and cached between CI runs
+MIRROR_DIR = os.environ.get(
+    "MIRROR_DIR", os.path.expanduser("~/.cache/autopkg-mirrors")
+)
+
+RECIPE_EXTS = (".recipe", ".recipe.plist", ".recipe.yaml")
+RECIPE_TYPE_PATTERN = re.compile(r"\/([\w\- ]+\.([\w\- ]+))\.recipe(\.yaml|\.plist)?$")
+
+# Parsed recipe data is cached here between runs. Bump the version whenever
+# the contents of index entries change, so stale cached entries are ignored.
+RECIPE_CACHE_PATH = ".recipe_cache.json"
+RECIPE_CACHE_VERSION = 3
 
 
 def get_all_repos():
     """Get API data on all repos in AutoPkg org."""
     repos = []
-    url = "https://api.github.com/orgs/autopkg/repos"
-    headers = {
-        "user-agent": "autopkg-search-index/0.0.1",
-        "accept": "application/vnd.github.v3+json",
-        "authorization": f"token {os.environ['PA_TOKEN']}",
-    }
+    url = "https://api.github.com/graphql"
+    session = requests.Session()
+    session.headers.update(
+        {
+            "user-agent": "autopkg-search-index/0.0.1",
+            "authorization": f"token {os.environ['PA_TOKEN']}",
+        }
+    )
+
+    # Retry transient server errors. The query is read-only, so it is safe
+    # to retry even though it is sent as a POST.
+    retries = Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=("POST",),
+    )
+    session.mount("https://", HTTPAdapter(max_retries=retries))
 
     # Loop through paginated results until there are no more pages
-    page = 1
+    cursor = None
     while True:
-        params = {"per_page": "100", "page": page}
-        response = requests.get(url, params=params, headers=headers).json()
-        if not response:
+        payload = {"query": REPOS_QUERY, "variables": {"cursor": cursor}}
+        response = session.post(url, json=payload)
+        response.raise_for_status()
+        response_data = response.json()
+        if response_data.get("errors"):
+            raise RuntimeError(f"GitHub API error: {response_data['errors']}")
+        results = response_data["data"]["organization"]["repositories"]
+
+        # Use the same keys as the REST API, so callers don't need to change
+        for node in results["nodes"]:
+            repos.append(
+                {
+                    "full_name": node["nameWithOwner"],
+                    "clone_url": f"{node['url']}.git",
+                    "private": node["isPrivate"],
+                    "fork": node["isFork"],
+                    "archived": node["isArchived"],
+                    "disabled": node["isDisabled"],
+                    "is_template": node["isTemplate"],
+                }
+            )
+        if not results["pageInfo"]["hasNextPage"]:
             break
-        repos.extend(response)
-        page += 1
+        cursor = results["pageInfo"]["endCursor"]
 
     # Filter out repos that are archived, private, or otherwise skippable
-    excl_reasons = ("private", "fork", "archived", "disabled", "is_template")
-    repos = [x for x in repos if not any([x.get(r) for r in excl_reasons])]
-    excl_names = ("autopkg/autopkg", "autopkg/index")
-    repos = [x for x in repos if x["full_name"] not in excl_names]
+    repos = [
+        x
+        for x in repos
+        if x["full_name"] not in EXCL_NAMES and not any(x.get(r) for r in EXCL_REASONS)
+    ]
 
     return repos
 
 
-def clone_all_repos(repos):
-    """Clone repos that are not private, archived, or otherwise skippable"""
-    for repo in repos:
-        if os.path.isdir(f"repos/{repo['full_name']}"):
-            continue
-        clone_cmd = [
+def _clone_one(repo):
+    """Shallow clone a single repo, skipping it if it's already present. A
+    local mirror of the repo is created or updated first and used as a
+    reference, so only objects that are new since the last run are
+    downloaded."""
+    dest = f"repos/{repo['full_name']}"
+    if os.path.isdir(dest):
+        return repo, 0, ""
+    mirror = os.path.join(MIRROR_DIR, f"{repo['full_name']}.git")
+    if os.path.isdir(mirror):
+        update_cmd = [
             "git",
-            "clone",
-            "--depth=1",
-            repo["clone_url"],
-            f"repos/{repo['full_name']}",
+            "-C",
+            mirror,
+            "fetch",
+            "--quiet",
+            "--prune",
+            "origin",
+            "+refs/heads/*:refs/heads/*",
         ]
-        subprocess.run(clone_cmd, check=True)
+    else:
+        update_cmd = ["git", "clone", "--bare", "--quiet", repo["clone_url"], mirror]
+
+    # Clone from GitHub rather than the mirror, so the checkout follows the
+    # repo's current default branch even if it changed since the mirror was made
+    clone_cmd = [
+        "git",
+        "clone",
+        "--depth=1",
+        "--quiet",
+        f"--reference-if-able={mirror}",
+        "--dissociate",
+        repo["clone_url"],
+        dest,
+    ]
+
+    # Fail fast instead of waiting on a credential prompt that never comes
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+
+    # The mirror only saves downloads, so a failure to update it isn't fatal.
+    # --reference-if-able skips a mirror that is missing or unusable.
+    proc = subprocess.run(
+        update_cmd, env=env, capture_output=True, text=True, check=False
+    )
+    if proc.returncode != 0:
+        print(
+            f"WARNING: Unable to update mirror of {repo['full_name']} "
+            f"({proc.returncode}): {proc.stderr.strip()}"
+        )
+
+    proc = subprocess.run(
+        clone_cmd, env=env, capture_output=True, text=True, check=False
+    )
+    return repo, proc.returncode, proc.stderr
 
 
-def resolve_var(recipe_dict, var_name):
+def clone_all_repos(repos):
+    """Clone repos that are not private, archived, or otherwise skippable"""
+    # Clones are network-bound, so run several at once
+    max_workers = int(os.environ.get("CLONE_JOBS", "8"))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_clone_one, repos))
+
+    failed = [x for x in results if x[1] != 0]
+    for repo, returncode, stderr in failed:
+        print(
+            f"ERROR: Unable to clone {repo['full_name']} ({returncode}): "
+            f"{stderr.strip()}"
+        )
+    if failed:
+        raise RuntimeError(f"Failed to clone {len(failed)} repo(s).")
+
+
+def resolve_var(input_dict, var_name):
     """Given a variable name wrapped in percents, resolve to the actual variable value."""
 
-    var_name = var_name.strip("%")
-    return recipe_dict.get("Input", {}).get(var_name)
+    return input_dict.get(var_name[1:-1])
+
+
+def load_recipe_cache():
+    """Load the index entries cached by a previous run, if any."""
+    try:
+        with open(RECIPE_CACHE_PATH, encoding="utf-8") as openfile:
+            cache = json.load(openfile)
+    except (OSError, ValueError):
+        return {}
+    if cache.get("version") != RECIPE_CACHE_VERSION:
+        return {}
+    return cache.get("recipes", {})
+
+
+def save_recipe_cache(cache):
+    """Save index entries so unchanged recipes can skip parsing next run."""
+    with open(RECIPE_CACHE_PATH, "w", encoding="utf-8") as openfile:
+        json.dump({"version": RECIPE_CACHE_VERSION, "recipes": cache}, openfile)
+
+
+def index_recipe(recipe, data, repo, repo_root, warnings):
+    """Parse the contents of a recipe file and return its identifier, index
+    entry, and child/parent edge, or None if the file can't be parsed."""
+    index_entry = {}
+    if recipe.endswith(".yaml"):
+        try:
+            recipe_dict = yaml.load(data, Loader=_YamlLoader)
+        except yaml.scanner.ScannerError:
+            recipe_dict = None
+        if not isinstance(recipe_dict, dict):
+            warnings.append(f"WARNING: Unable to parse {recipe} as yaml")
+            return None
+    else:
+        try:
+            # Recipes are almost always XML, so skip plistlib's format detection
+            if data.startswith(b"bplist00"):
+                recipe_dict = plistlib.loads(data, fmt=plistlib.FMT_BINARY)
+            else:
+                recipe_dict = plistlib.loads(data, fmt=plistlib.FMT_XML)
+        except (plistlib.InvalidFileException, ExpatError, ValueError):
+            recipe_dict = None
+        if not isinstance(recipe_dict, dict):
+            warnings.append(f"WARNING: Unable to parse {recipe} as plist")
+            return None
+
+    # Check for deprecation up front, stopping at the first matching processor
+    process = recipe_dict.get("Process") or ()
+    deprecated = any(x.get("Processor") == "DeprecationWarning" for x in process)
+
+    # Generally applicable metadata
+    child_edge = None
+    input_dict = recipe_dict.get("Input") or {}
+    index_entry["name"] = input_dict.get("NAME")
+    index_entry["description"] = recipe_dict.get("Description")
+    index_entry["repo"] = repo["full_name"]
+    index_entry["path"] = os.path.relpath(recipe, repo_root)
+    if recipe_dict.get("ParentRecipe"):
+        index_entry["parent"] = recipe_dict["ParentRecipe"]
+        child_edge = (recipe_dict["Identifier"], recipe_dict["ParentRecipe"])
+    if deprecated:
+        index_entry["deprecated"] = True
+
+    # Get inferred type of recipe
+    match = RECIPE_TYPE_PATTERN.search(index_entry["path"])
+    if match:
+        index_entry["shortname"] = match.group(1)
+        index_entry["inferred_type"] = match.group(2)
+
+    # Munki-specific metadata
+    if index_entry.get("inferred_type") == "munki":
+        pkginfo = input_dict.get("pkginfo", {})
+        index_entry["munki_display_name"] = pkginfo.get("display_name")
+        index_entry["munki_description"] = pkginfo.get("description")
+
+    # Jamf-specific metadata
+    if index_entry.get("inferred_type") in ("jss", "jamf"):
+        index_entry["jamf_display_name"] = input_dict.get("SELF_SERVICE_DISPLAY_NAME")
+        index_entry["jamf_description"] = input_dict.get("SELF_SERVICE_DESCRIPTION")
+
+    # Resolve any substitution variables in the index entry
+    for k, v in index_entry.items():
+        if isinstance(v, str) and v.startswith("%") and v.endswith("%"):
+            index_entry[k] = resolve_var(input_dict, v)
+
+    return {
+        "identifier": recipe_dict.get("Identifier"),
+        "entry": index_entry,
+        "child_edge": child_edge,
+    }
+
+
+def iter_recipes(path, max_depth=2, depth=0):
+    """Yield paths of recipe files in the subfolders of path, searching up to
+    max_depth folders deep and skipping hidden files and folders."""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                if depth < max_depth:
+                    yield from iter_recipes(entry.path, max_depth, depth + 1)
+            elif depth > 0 and entry.name.endswith(RECIPE_EXTS) and entry.is_file():
+                yield entry.path
+
+
+def index_repo(repo, repo_cache):
+    """Index the recipes in a cloned repo, reusing cached data for any recipe
+    whose contents haven't changed since the last run.
+
+    Runs in a worker process, so results and warnings are returned rather
+    than written to shared state.
+    """
+    results = {}
+    warnings = []
+
+    # Find recipe files up to 2 levels deep
+    repo_root = f"repos/{repo['full_name']}"
+    recipes = sorted(iter_recipes(repo_root))
+
+    # Get indexable data from recipe files
+    for recipe in recipes:
+        with open(recipe, "rb") as openfile:
+            data = openfile.read()
+        recipe_hash = hashlib.sha256(data).hexdigest()
+        result = repo_cache.get(recipe)
+        if not result or result["sha256"] != recipe_hash:
+            result = index_recipe(recipe, data, repo, repo_root, warnings)
+            if result is None:
+                continue
+            result["sha256"] = recipe_hash
+        results[recipe] = result
+
+    return results, warnings
 
 
 def build_search_index(repos):
     """Given a list of repo info from the GitHub API, build recipe search index."""
     index = {
         "identifiers": {},
-        "shortnames": {},
+        "shortnames": defaultdict(list),
     }
     children = []
-    for repo in repos:
-        # Find recipe files up to 2 levels deep
-        recipes = glob(f"repos/{repo['full_name']}/*/*.recipe")
-        recipes += glob(f"repos/{repo['full_name']}/*/*/*.recipe")
-        recipes += glob(f"repos/{repo['full_name']}/*/*.recipe.plist")
-        recipes += glob(f"repos/{repo['full_name']}/*/*/*.recipe.plist")
-        recipes += glob(f"repos/{repo['full_name']}/*/*.recipe.yaml")
-        recipes += glob(f"repos/{repo['full_name']}/*/*/*.recipe.yaml")
-
-        # Filter out any directories
-        recipes = [r for r in recipes if os.path.isfile(r)]
-
-        # Get indexable data from recipe files
-        for recipe in recipes:
-            index_entry = {}
-            if recipe.endswith(".yaml"):
-                try:
-                    with open(recipe, "rb") as openfile:
-                        recipe_dict = yaml.safe_load(openfile)
-                except yaml.scanner.ScannerError:
-                    print(f"WARNING: Unable to parse {recipe} as yaml")
-            else:
-                try:
-                    with open(recipe, "rb") as openfile:
-                        recipe_dict = plistlib.load(openfile)
-                except (plistlib.InvalidFileException, ExpatError, ValueError):
-                    print(f"WARNING: Unable to parse {recipe} as plist")
-
-            # Generally applicable metadata
-            input_dict = recipe_dict.get("Input", {})
-            index_entry["name"] = input_dict.get("NAME")
-            index_entry["description"] = recipe_dict.get("Description")
-            index_entry["repo"] = repo["full_name"]
-            index_entry["path"] = os.path.relpath(recipe, f"repos/{repo['full_name']}")
-            if recipe_dict.get("ParentRecipe"):
-                index_entry["parent"] = recipe_dict["ParentRecipe"]
-                children.append(
-                    (recipe_dict["Identifier"], recipe_dict["ParentRecipe"])
-                )
-            if any(
-                [
-                    x.get("Processor") == "DeprecationWarning"
-                    for x in recipe_dict.get("Process", [{}])
-                ]
-            ):
-                index_entry["deprecated"] = True
-
-            # Get inferred type of recipe
-            type_pattern = r"\/([\w\- ]+\.([\w\- ]+))\.recipe(\.yaml|\.plist)?$"
-            match = re.search(type_pattern, index_entry["path"])
-            if match:
-                index_entry["shortname"] = match.group(1)
-                index_entry["inferred_type"] = match.group(2)
-
-            # Munki-specific metadata
-            if index_entry.get("inferred_type") == "munki":
-                pkginfo = input_dict.get("pkginfo", {})
-                index_entry["munki_display_name"] = pkginfo.get("display_name")
-                index_entry["munki_description"] = pkginfo.get("description")
-
-            # Jamf-specific metadata
-            if index_entry.get("inferred_type") in ("jss", "jamf"):
-                index_entry["jamf_display_name"] = input_dict.get(
-                    "SELF_SERVICE_DISPLAY_NAME"
-                )
-                index_entry["jamf_description"] = input_dict.get(
-                    "SELF_SERVICE_DESCRIPTION"
-                )
-
-            # Resolve any substitution variables in the index entry
-            for k, v in index_entry.items():
-                if isinstance(v, str) and v.startswith("%") and v.endswith("%"):
-                    index_entry[k] = resolve_var(recipe_dict, v)
-
-            # Save entry to identifier index
-            index["identifiers"][recipe_dict.get("Identifier")] = index_entry
-
-            # Save entry to shortnames index
-            if index_entry.get("shortname"):
-                if index_entry["shortname"] in index["shortnames"]:
-                    index["shortnames"][index_entry["shortname"]].append(
-                        recipe_dict.get("Identifier")
-                    )
-                else:
-                    index["shortnames"][index_entry["shortname"]] = [
-                        recipe_dict.get("Identifier")
-                    ]
+    warnings = []
+    cache = load_recipe_cache()
+    new_cache = {}
+
+    # Parse each repo's recipes in parallel, then merge the results in order
+    repo_caches = [cache.get(repo["full_name"], {}) for repo in repos]
+    with ProcessPoolExecutor() as executor:
+        repo_results = executor.map(index_repo, repos, repo_caches, chunksize=4)
+        for repo, (results, repo_warnings) in zip(repos, repo_results):
+            warnings.extend(repo_warnings)
+            new_cache[repo["full_name"]] = results
+
+            for result in results.values():
+                # Copy the entry, since the children pass below modifies it
+                identifier = result["identifier"]
+                index_entry = dict(result["entry"])
+                if result["child_edge"]:
+                    children.append(tuple(result["child_edge"]))
+
+                # Save entry to identifier index
+                index["identifiers"][identifier] = index_entry
+
+                # Save entry to shortnames index
+                if index_entry.get("shortname"):
+                    index["shortnames"][index_entry["shortname"]].append(identifier)
 
     # Add children list to parent recipes' index entries
     for child in children:
         if child[1] not in index["identifiers"]:
-            print(f"WARNING: {child[0]} refers to missing parent recipe {child[1]}.")
+            warnings.append(
+                f"WARNING: {child[0]} refers to missing parent recipe {child[1]}."
+            )
         else:
             if "children" in index["identifiers"][child[1]]:
                 index["identifiers"][child[1]]["children"].append(child[0])
             else:
                 index["identifiers"][child[1]]["children"] = [child[0]]
 
+    # Print all warnings in one write rather than one per warning
+    if warnings:
+        sys.stdout.write("\n".join(warnings) + "\n")
+
     # Write index file
     with open("index.json", "w", encoding="utf-8") as openfile:
-        openfile.write(json.dumps(index, indent=2))
+        json.dump(index, openfile, indent=2)
+
+    # Only keep cache entries for recipes that still exist
+    save_recipe_cache(new_cache)
 
 
 def main():